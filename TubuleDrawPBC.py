@@ -0,0 +1,79 @@
+import numpy as np
+
+
+def junctionPoints(substrate):
+    """ Returns the integer screen position of every live
+        junction as an (n, 2) array """
+
+    n = substrate.n_junctions
+    live = np.flatnonzero(substrate.alive_j[:n])
+    points = substrate.pos[live].astype(np.int32)
+    points[:, 0] %= substrate.width
+    return(points)
+
+
+def tubuleSegments(substrate):
+    """ Returns every live tubule as integer x1, y1, x2, y2 line
+        segments in an (n, 4) array - tubules that cross the x bound
+        are split into two segments """
+
+    n = substrate.n_tubules
+    live = np.flatnonzero(substrate.alive_t[:n])
+    p1 = substrate.pos[substrate.j1_idx[live]]
+    p2 = substrate.pos[substrate.j2_idx[live]]
+    crossed = substrate.crossover[live] != 0
+    width = substrate.width
+
+    whole = np.hstack([p1[~crossed], p2[~crossed]])
+
+    # Finds the correct y coordinate where the tube crosses the
+    # x bound and draws two lines
+    #
+    # There are sometimes drawing errors (not sure where they're
+    # coming from) where tubules will flicker across the screen,
+    # but this doesn't reflect the system physics
+    a = p1[crossed]
+    b = p2[crossed]
+    a_first = (a[:, 0] <= b[:, 0])[:, None]
+    (x_min, y_min) = np.where(a_first, a, b).T
+    (x_max, y_max) = np.where(a_first, b, a).T
+
+    dx = x_max - x_min
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f_x1 = x_min / (width - dx)
+        f_x2 = (width - x_max) / (width - dx)
+    f_y = y_max * f_x1 + y_min * f_x2
+
+    left = np.column_stack([np.zeros_like(f_y), f_y, x_min, y_min])
+    right = np.column_stack([x_max, y_max, np.full_like(f_y, width), f_y])
+
+    segments = np.vstack([whole, left, right])
+    return(np.nan_to_num(segments).astype(np.int32))
+
+
+def tubulePixels(substrate):
+    """ Rasterizes every tubule segment into the pixels it covers
+        and returns them as an (m, 2) array of x, y indices, so the
+        whole network can be drawn with one array assignment """
+
+    (width, height) = (substrate.width, substrate.height)
+    (x1, y1, x2, y2) = tubuleSegments(substrate).astype(np.int64).T
+
+    # Steps one pixel at a time along the longer axis of each
+    # segment - k is the step number within its own segment. No
+    # line crossing the screen is longer than width + height, which
+    # caps the steps for segments with broken far off coordinates
+    steps = np.minimum(np.maximum(abs(x2 - x1), abs(y2 - y1)),
+                       width + height) + 1
+    k = np.arange(steps.sum()) - np.repeat(steps.cumsum() - steps, steps)
+    f = k / np.repeat(np.maximum(steps - 1, 1), steps)
+
+    x = np.repeat(x1, steps) + f * np.repeat(x2 - x1, steps)
+    y = np.repeat(y1, steps) + f * np.repeat(y2 - y1, steps)
+    pixels = np.column_stack([x, y]).round().astype(np.intp)
+
+    # Segments running off the screen keep their slope and just
+    # lose the pixels outside it
+    on_screen = ((pixels[:, 0] >= 0) & (pixels[:, 0] < width)
+                 & (pixels[:, 1] >= 0) & (pixels[:, 1] < height))
+    return(pixels[on_screen])
@@ -0,0 +1,66 @@
+# cython: language_level=3
+""" Compiled version of the collinearity test in Substrate.mergeTubules,
+    built by pyximport the first time TubulePhysicsPBC is imported """
+
+cimport cython
+from libc.math cimport sqrt
+import numpy as np
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def mergeHits(const double[:, :] pos, const Py_ssize_t[:] j_idx,
+              const Py_ssize_t[:] t_idx, const Py_ssize_t[:] j1,
+              const Py_ssize_t[:] j2, const signed char[:] crossover,
+              const float[:] norm, const float[:, :] unit,
+              const float[:, :] aabb, double width):
+    """ Returns whether each open junction j_idx[k] is close enough
+        to collinear with tubule t_idx[k] to merge into it """
+
+    cdef Py_ssize_t n = j_idx.shape[0]
+    cdef Py_ssize_t k, j, t, a, b
+    cdef double jx, vx, vy, j_norm, col_check, dot
+
+    hits = np.zeros(n, dtype=np.uint8)
+    cdef unsigned char[:] hits_view = hits
+
+    for k in range(n):
+        j = j_idx[k]
+        t = t_idx[k]
+        a = j1[t]
+        b = j2[t]
+
+        # Vector from tubule end 1 to the open junction, corrected
+        # for tubules that cross the x bound
+        jx = pos[j, 0]
+        vx = jx - pos[a, 0]
+        vy = pos[j, 1] - pos[a, 1]
+        if crossover[t] > 0 and jx < pos[b, 0]:
+            vx += width
+        elif crossover[t] < 0 and jx > pos[b, 0]:
+            vx -= width
+
+        # Skips pairs outside the tubule's padded bounding box
+        if not (aabb[t, 0] <= pos[a, 0] + vx <= aabb[t, 1]
+                and aabb[t, 2] <= pos[j, 1] <= aabb[t, 3]):
+            continue
+
+        j_norm = sqrt(vx * vx + vy * vy)
+
+        # Prevents attachment from outside the tubule's max length
+        if not j_norm <= norm[t]:
+            continue
+
+        # More forgiving when j_norm is small to prevent crossovers
+        if j_norm < 0.1:
+            col_check = 0
+        elif j_norm < 1:
+            col_check = 0.9
+        else:
+            col_check = 0.999
+
+        dot = (vx * unit[t, 0] + vy * unit[t, 1]) / j_norm
+        hits_view[k] = dot > col_check
+
+    return(hits.view(bool))
@@ -1,98 +1,397 @@
+import math
 import random
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
 
-class Junction:
-    """ Intersections and connections between tubules/boundary """
-
-    def __init__(self, x, y):
-
-        self.position = np.array([x, y])
-        self.velocity = np.array([0.0, 0.0])
-        self.vector = np.array([0, 0])
-
-        self.flowing = False
-        self.growing = False
-        self.anchor = False
-        self.flowrate = np.array([0.0, 0.0])
-        self.dragrate = 1
-        self.cross = 0
-        self.width = 0
-        self.adjacent = []
-        self.just_split = True
+# The parallel kernels split their loops over numba's thread pool -
+# set NUMBA_NUM_THREADS to cap how many cores they use
+prange = range if numba is None else numba.prange
 
-    def moveJunction(self):
-        """ Updates position with given velocity, acceleration,
-            and drag """
+# mergeTubules uses the compiled test in TubuleMergePBC.pyx when
+# Cython is installed and falls back to NumPy otherwise - the .pyx
+# import hook is removed again so importers of this module keep
+# their normal import behaviour
+try:
+    import pyximport
+    importers = pyximport.install(language_level=3)
+    try:
+        import TubuleMergePBC
+    finally:
+        pyximport.uninstall(*importers)
+except ImportError:
+    TubuleMergePBC = None
+
+# Single precision is plenty for a substrate a few hundred units wide
+# and halves the memory each timestep has to stream through. The
+# memoryviews in TubuleMergePBC.pyx are typed for FLOAT = float32 and
+# POS_FLOAT = float64 - mergeTubules uses NumPy for any other dtypes
+# unless the .pyx is changed to match
+FLOAT = np.float32
+
+# Junction positions stay in double precision though - the default
+# flow step of 1e-7 is below single precision resolution at substrate
+# scale and would be rounded away
+POS_FLOAT = np.float64
+
+
+def _njit(**options):
+    """ Compiles a timestep kernel with numba when it's installed -
+        without numba the kernel just runs as plain Python """
+
+    if numba is None:
+        return(lambda f: f)
+
+    # Zero length tubules give nan like numpy instead of raising
+    options.setdefault('error_model', 'numpy')
+    return(numba.njit(**options))
+
+
+# Timestep kernels - each one is a plain loop over the substrate
+# arrays so numba can compile it without any temporary arrays
+
+@_njit(cache=True, fastmath=True, parallel=True)
+def _step_move(pos, vel, anchor, flowrate, dragrate, flowing, cross, width):
+    """ Moves every junction by its velocity and applies drag """
+
+    for i in prange(pos.shape[0]):
 
         # Wraparound happens at the junction level - buggy to do
         # on the tubules directly
-        if not self.anchor:
-            if self.cross > 0:
-                self.position[0] %= self.width
-                self.cross = 0
-            if self.cross < 0:
-                self.position[0] %= self.width
-                self.cross = 0
+        if not anchor[i] and cross[i] != 0:
+            pos[i, 0] %= width
+            cross[i] = 0
 
         # System flow still unimplemented
-        if self.flowing:
-            self.position += self.flowrate
+        if flowing[i]:
+            pos[i, 0] += flowrate[i, 0]
+            pos[i, 1] += flowrate[i, 1]
+
+        if not anchor[i]:
+            pos[i, 0] += vel[i, 0]
+            pos[i, 1] += vel[i, 1]
+            vel[i, 0] *= dragrate[i]
+            vel[i, 1] *= dragrate[i]
+
+
+@_njit(cache=True, fastmath=True)
+def _step_bound(pos, anchor, growing, width, height, bound_x):
+    """ Clamps junctions to the substrate bounds and anchors them -
+        written without branches so the loop compiles to selects -
+        returns how many junctions newly stopped moving """
+
+    stopped = 0
+    for i in range(pos.shape[0]):
+
+        hit = (pos[i, 1] > height) | (pos[i, 1] < 0)
+        pos[i, 1] = min(max(pos[i, 1], 0.0), height)
+
+        if bound_x:
+            hit |= (pos[i, 0] > width) | (pos[i, 0] < 0)
+            pos[i, 0] = min(max(pos[i, 0], 0.0), width)
+
+        stopped += hit & (growing[i] | (not anchor[i]))
+        anchor[i] |= hit
+        growing[i] &= not hit
+
+    return(stopped)
+
+
+@_njit(cache=True, fastmath=True, parallel=True)
+def _step_update_tubule(pos, j1, j2, active, crossover, width,
+                        vec_out, norm_out, unit_out):
+    """ Recomputes the vector, length and direction of each tubule
+        in active and returns how much the total tubule length
+        changed """
+
+    delta = 0.0
+    for k in prange(active.shape[0]):
+        i = active[k]
+        shift = FLOAT(width * int(crossover[i]))
+        vx = pos[j2[i], 0] - pos[j1[i], 0] + shift
+        vy = pos[j2[i], 1] - pos[j1[i], 1]
+        norm = np.sqrt(vx * vx + vy * vy)
+        inv = FLOAT(1.0) / norm
+        delta += float(norm - norm_out[i])
+        vec_out[i, 0] = vx
+        vec_out[i, 1] = vy
+        norm_out[i] = norm
+        unit_out[i, 0] = vx * inv
+        unit_out[i, 1] = vy * inv
+
+    return(delta)
+
+
+@_njit(cache=True, fastmath=True, parallel=True)
+def _step_gather(pos, vel, inc_start, inc_tubule, inc_sign, vec, unit,
+                 hookes, growth, contracting, anchor, growing,
+                 contract, grow):
+    """ Adds the Hooke's law pull and the growth push of every tubule
+        to its end junctions - each junction sums its own contiguous
+        run of the incidence list instead of tubules scattering into
+        random junction rows, so the junctions can run in parallel
+        without atomics """
+
+    for j in prange(inc_start.shape[0] - 1):
+
+        pull = contract and not anchor[j]
+        push = grow and growing[j]
+        if not (pull or push):
+            continue
+
+        # inc_sign is +1 where j is end 1 of the tubule and -1
+        # where it is end 2
+        dvx = FLOAT(0.0)
+        dvy = FLOAT(0.0)
+        dpx = FLOAT(0.0)
+        dpy = FLOAT(0.0)
+        for k in range(inc_start[j], inc_start[j + 1]):
+            i = inc_tubule[k]
+            sign = inc_sign[k]
+            if pull and contracting[i]:
+                dvx += sign * hookes[i] * vec[i, 0]
+                dvy += sign * hookes[i] * vec[i, 1]
+            if push:
+                dvx -= sign * hookes[i] * vec[i, 0]
+                dvy -= sign * hookes[i] * vec[i, 1]
+                dpx -= sign * growth[i] * unit[i, 0]
+                dpy -= sign * growth[i] * unit[i, 1]
+
+        vel[j, 0] += dvx
+        vel[j, 1] += dvy
+        pos[j, 0] += dpx
+        pos[j, 1] += dpy
+
+
+@_njit(cache=True, fastmath=True)
+def _step_wrap(pos, j1, j2, alive, crossover, cross, width):
+    """ Tracks which tubule ends have crossed the x bound - side is
+        +1 past the right bound, -1 past the left and 0 inside, and
+        the counters saturate at +-1 without branching - returns how
+        many tubule crossovers changed """
+
+    changed = 0
+    for i in range(j1.shape[0]):
+        if not alive[i]:
+            continue
+
+        before = crossover[i]
+        side = int(pos[j1[i], 0] > width) - int(pos[j1[i], 0] < 0)
+        crossover[i] = min(max(crossover[i] - side, -1), 1)
+        cross[j1[i]] = min(max(cross[j1[i]] + side, -1), 1)
+
+        side = int(pos[j2[i], 0] > width) - int(pos[j2[i], 0] < 0)
+        crossover[i] = min(max(crossover[i] + side, -1), 1)
+        cross[j2[i]] = min(max(cross[j2[i]] + side, -1), 1)
+        changed += crossover[i] != before
+
+    return(changed)
+
+
+# Spatial hash over tubules for mergeTubule - the primes are the
+# usual ones for hashing integer grid coordinates
+HASH_P1 = 73856093
+HASH_P2 = 19349663
+
+
+@_njit(cache=True)
+def _cell_hash(ix, iy, n_hash):
+    """ Hashes a grid cell to a bucket """
+
+    return(((HASH_P1 * ix) ^ (HASH_P2 * iy)) % n_hash)
+
+
+@_njit(cache=True)
+def _build_hash(pos, j1, j2, alive, crossover, norm, width,
+                cell_w, cell_h, n_cx, n_hash):
+    """ Bins every tubule into each grid cell its bounding box
+        overlaps and returns the buckets in compressed row form -
+        the tubules of bucket h are
+        cell_tubules[cell_start[h]:cell_start[h + 1]] - along with
+        the padded boxes themselves as xmin, xmax, ymin, ymax rows """
+
+    n = j1.shape[0]
+    box = np.empty((n, 4), dtype=np.int64)
+    aabb = np.full((n, 4), np.nan, dtype=norm.dtype)
+    counts = np.zeros(n_hash + 1, dtype=np.int64)
+
+    for i in range(n):
+
+        # Removed and zero length tubules can never be merged into
+        if not (alive[i] and norm[i] > 0):
+            box[i, 0] = 0
+            box[i, 1] = -1
+            continue
+
+        # The box is padded by how far off the tubule mergeTubule
+        # still accepts a junction, plus a margin for movement
+        # since the last update
+        pad = 1.0 + 0.05 * norm[i]
+        x1 = pos[j1[i], 0]
+        y1 = pos[j1[i], 1]
+        x2 = pos[j2[i], 0] + width * int(crossover[i])
+        y2 = pos[j2[i], 1]
+        aabb[i, 0] = min(x1, x2) - pad
+        aabb[i, 1] = max(x1, x2) + pad
+        aabb[i, 2] = min(y1, y2) - pad
+        aabb[i, 3] = max(y1, y2) + pad
+        box[i, 0] = int(np.floor(aabb[i, 0] / cell_w))
+        box[i, 1] = int(np.floor(aabb[i, 1] / cell_w))
+        box[i, 2] = int(np.floor(aabb[i, 2] / cell_h))
+        box[i, 3] = int(np.floor(aabb[i, 3] / cell_h))
+
+        # Cells wrap in x, so a box never needs more than n_cx columns
+        box[i, 1] = min(box[i, 1], box[i, 0] + n_cx - 1)
+
+        for ix in range(box[i, 0], box[i, 1] + 1):
+            for iy in range(box[i, 2], box[i, 3] + 1):
+                counts[_cell_hash(ix % n_cx, iy, n_hash) + 1] += 1
+
+    cell_start = np.cumsum(counts)
+    cell_tubules = np.empty(cell_start[-1], dtype=np.int64)
+    fill = cell_start[:-1].copy()
+
+    for i in range(n):
+        for ix in range(box[i, 0], box[i, 1] + 1):
+            for iy in range(box[i, 2], box[i, 3] + 1):
+                h = _cell_hash(ix % n_cx, iy, n_hash)
+                cell_tubules[fill[h]] = i
+                fill[h] += 1
+
+    return(cell_start, cell_tubules, aabb)
+
+
+@_njit(cache=True)
+def _find_buckets(pos, cell_w, cell_h, n_cx, n_hash):
+    """ Returns the hash bucket of the cell holding each position """
+
+    buckets = np.empty(pos.shape[0], dtype=np.int64)
+    for i in range(pos.shape[0]):
+        ix = int(np.floor(pos[i, 0] / cell_w)) % n_cx
+        iy = int(np.floor(pos[i, 1] / cell_h))
+        buckets[i] = _cell_hash(ix, iy, n_hash)
+    return(buckets)
+
+
+def _resize(array, length):
+    """ Returns a copy of array with room for length rows """
+
+    resized = np.zeros((length,) + array.shape[1:], dtype=array.dtype)
+    resized[:len(array)] = array
+    return(resized)
 
-        if not self.anchor:
-            self.position += self.velocity
-            self.velocity *= self.dragrate
+
+class Junction:
+    """ Intersections and connections between tubules/boundary -
+        the junction state itself lives in row self.index of the
+        substrate arrays, and index is None once compaction has
+        dropped the row """
+
+    __slots__ = ('substrate', 'index', 'adjacent', 'just_split')
+
+    def __init__(self, substrate, index):
+
+        self.substrate = substrate
+        self.index = index
+        self.adjacent = set()
+        self.just_split = True
+
+    @property
+    def position(self):
+        return(self.substrate.pos[self.index])
+
+    @property
+    def velocity(self):
+        return(self.substrate.vel[self.index])
+
+    @property
+    def anchor(self):
+        return(self.substrate.anchor[self.index])
+
+    @anchor.setter
+    def anchor(self, value):
+        self.substrate.anchor[self.index] = value
+        self.substrate.static_mask = None
+
+    @property
+    def growing(self):
+        return(self.substrate.growing[self.index])
+
+    @growing.setter
+    def growing(self, value):
+        self.substrate.growing[self.index] = value
+        self.substrate.static_mask = None
+
+    @property
+    def cross(self):
+        return(self.substrate.cross[self.index])
+
+    @property
+    def alive(self):
+        if self.index is None:
+            return(False)
+        return(self.substrate.alive_j[self.index])
 
 
 class Tubule:
-    """ Tubules defined by two junction endpoints """
+    """ Tubules defined by two junction endpoints - the tubule
+        state itself lives in row self.index of the substrate
+        arrays, and index is None once compaction has dropped the
+        row """
 
-    def __init__(self, j1, j2):
+    __slots__ = ('substrate', 'index', 'j1', 'j2')
 
+    def __init__(self, substrate, index, j1, j2):
+
+        self.substrate = substrate
+        self.index = index
         self.j1 = j1
         self.j2 = j2
-        self.width = 0
-        self.crossover = 0
 
-        # Most the tubule physics are done with vectors instead
-        # of absolute positions
-        self.vector = self.j2.position - self.j1.position
-        self.vector[0] += self.width * self.crossover
+    @property
+    def alive(self):
+        if self.index is None:
+            return(False)
+        return(self.substrate.alive_t[self.index])
 
-        self.norm = np.linalg.norm(self.vector)
-        self.unit = self.vector / np.linalg.norm(self.vector)
+    @property
+    def crossover(self):
+        return(self.substrate.crossover[self.index])
 
-        self.hookes = 0
-        self.growth = 0
-        self.contracting = True
+    @property
+    def vector(self):
+        return(self.substrate.vec[self.index])
 
-    def updateTubule(self):
-        """ Updates self.vector once per unit time """
+    @property
+    def norm(self):
+        return(self.substrate.norm[self.index])
 
-        self.vector -= self.vector
-        self.vector += self.j2.position
-        self.vector[0] += self.width * self.crossover
-        self.vector -= self.j1.position
-        self.norm = np.linalg.norm(self.vector)
-        self.unit = self.vector / np.linalg.norm(self.vector)
+    @property
+    def unit(self):
+        return(self.substrate.unit[self.index])
 
-    def contractTubule(self):
-        """ Pulls tubule ends together (Hooke's Law) """
+    def updateTubule(self):
+        """ Updates the vector of this tubule alone - the whole
+            system is updated at once by Substrate.updateTubules """
 
-        if not self.j1.anchor and self.contracting:
-            self.j1.velocity += self.hookes * self.vector
-        if not self.j2.anchor and self.contracting:
-            self.j2.velocity -= self.hookes * self.vector
+        s = self.substrate
+        i = self.index
+        (x1, y1) = s.pos[self.j1.index].tolist()
+        (x2, y2) = s.pos[self.j2.index].tolist()
 
-    def growTubule(self):
-        """ Grows open tubules """
+        # Most the tubule physics are done with vectors instead
+        # of absolute positions
+        vx = x2 - x1 + s.width * int(s.crossover[i])
+        vy = y2 - y1
+        norm = math.sqrt(vx * vx + vy * vy)
+        inv = 1.0 / norm if norm > 0 else math.nan
 
-        if self.j1.growing:
-            self.j1.velocity -= self.hookes * self.vector
-            self.j1.position -= self.growth * self.vector / self.norm
-        if self.j2.growing:
-            self.j2.velocity += self.hookes * self.vector
-            self.j2.position += self.growth * self.vector / self.norm
+        s.vec[i] = (vx, vy)
+        s.norm[i] = norm
+        s.unit[i] = (vx * inv, vy * inv)
 
 
 class Substrate:
@@ -114,26 +413,89 @@ class Substrate:
         self.growth = kargs.get('growth', 0.5)
         self.contracting = kargs.get('contracting', True)
 
+        # Removed rows are only flagged dead - every compact_every
+        # timesteps the dead rows are dropped from the arrays
+        self.compact_every = kargs.get('compact_every', 100)
+        self.ticks = 0
+
+        # Junction and tubule state is kept in parallel arrays with
+        # one row per object so every timestep function runs over the
+        # whole system at once - Junction and Tubule objects are just
+        # handles onto a row
+        self.n_junctions = 0
+        self.alive_j = np.zeros(0, dtype=bool)
+        self.pos = np.zeros((0, 2), dtype=POS_FLOAT)
+        self.vel = np.zeros((0, 2), dtype=FLOAT)
+        self.anchor = np.zeros(0, dtype=bool)
+        self.growing = np.zeros(0, dtype=bool)
+        self.cross = np.zeros(0, dtype=np.int8)
+        self.j_flowing = np.zeros(0, dtype=bool)
+        self.j_flowrate = np.zeros((0, 2), dtype=FLOAT)
+        self.j_dragrate = np.zeros(0, dtype=FLOAT)
+
+        self.n_tubules = 0
+        self.alive_t = np.zeros(0, dtype=bool)
+        self.j1_idx = np.zeros(0, dtype=np.intp)
+        self.j2_idx = np.zeros(0, dtype=np.intp)
+        self.crossover = np.zeros(0, dtype=np.int8)
+        self.vec = np.zeros((0, 2), dtype=FLOAT)
+        self.norm = np.zeros(0, dtype=FLOAT)
+        self.unit = np.zeros((0, 2), dtype=FLOAT)
+        self.t_hookes = np.zeros(0, dtype=FLOAT)
+        self.t_growth = np.zeros(0, dtype=FLOAT)
+        self.t_contracting = np.zeros(0, dtype=bool)
+
+        # Spatial hash over the tubules, rebuilt by mergeTubules
+        # whenever there are open junctions to check, and the padded
+        # tubule bounding boxes it was built from
+        self.cell_w = width
+        self.cell_h = height
+        self.n_cx = 1
+        self.n_hash = 1
+        self.cell_start = np.zeros(2, dtype=np.int64)
+        self.cell_tubules = np.zeros(0, dtype=np.int64)
+        self.t_aabb = np.zeros((0, 4), dtype=FLOAT)
+
+        # Tubules ending at each junction in compressed row form,
+        # rebuilt whenever the network changes
+        self.inc_start = np.zeros(1, dtype=np.intp)
+        self.inc_tubule = np.zeros(0, dtype=np.intp)
+        self.inc_sign = np.zeros(0, dtype=FLOAT)
+        self._incidence_stale = True
+
+        # Total length of the live tubules, kept up to date as they
+        # change, and its running sum over them for splitTubule
+        self._sys_len = 0.0
+        self._live_t = np.zeros(0, dtype=np.intp)
+        self._norm_cumsum = None
+
+        # Tubules whose ends are both anchored, not growing and not
+        # flowing never change, so the update kernel only visits
+        # _active_t - None until the next updateTubules rebuilds it
+        self.static_mask = None
+        self._active_t = np.zeros(0, dtype=np.intp)
+
         self.junctions = []
         self.tubules = []
         self.j_functions = []
         self.t_functions = []
+        self._tick_plan = []
 
-        # Dictionary of anonymous functions - can enable/disable when
+        # Dictionary of timestep functions - can enable/disable when
         # calling the substrate at the beginning of the simulation script
         self.function_dict = {
-            'moveJunction': (1, lambda j: j.moveJunction()),
-            'boundSubstrate': (1, lambda j: self.boundSubstrate(j)),
-            'mergeTubule': (1, lambda j: self.mergeTubule(j)),
-            'updateTubule': (2, lambda t: t.updateTubule()),
-            'contractTubule': (2, lambda t: t.contractTubule()),
-            'growTubule': (2, lambda t: t.growTubule()),
-            'pruneTubule': (2, lambda t: self.pruneTubule(t)),
-            'wrapSubstrate': (2, lambda t: self.wrapSubstrate(t))
+            'moveJunction': (1, self.moveJunctions),
+            'boundSubstrate': (1, self.boundSubstrate),
+            'mergeTubule': (1, self.mergeTubules),
+            'updateTubule': (2, self.updateTubules),
+            'contractTubule': (2, self.contractTubules),
+            'growTubule': (2, self.growTubules),
+            'pruneTubule': (2, self.pruneTubules),
+            'wrapSubstrate': (2, self.wrapSubstrate)
         }
 
     def addFunctions(self, function_list):
-        """ Adds anonymous functions to run each timestep """
+        """ Adds functions to run each timestep """
 
         for func in function_list:
             (n, f) = self.function_dict.get(func, (-1, None))
@@ -144,259 +506,478 @@ class Substrate:
             else:
                 print("No such function: %s" % func)
 
+        # Junction functions always run before tubule functions - the
+        # plan is fixed here so each timestep is one flat pass over it
+        self._tick_plan = self.j_functions + self.t_functions
+
+    def _grow_arrays(self):
+        """ Doubles the row capacity of the junction or tubule
+            arrays once they are full """
+
+        if self.n_junctions == len(self.pos):
+            length = max(16, 2 * len(self.pos))
+            self.alive_j = _resize(self.alive_j, length)
+            self.pos = _resize(self.pos, length)
+            self.vel = _resize(self.vel, length)
+            self.anchor = _resize(self.anchor, length)
+            self.growing = _resize(self.growing, length)
+            self.cross = _resize(self.cross, length)
+            self.j_flowing = _resize(self.j_flowing, length)
+            self.j_flowrate = _resize(self.j_flowrate, length)
+            self.j_dragrate = _resize(self.j_dragrate, length)
+
+        if self.n_tubules == len(self.j1_idx):
+            length = max(16, 2 * len(self.j1_idx))
+            self.alive_t = _resize(self.alive_t, length)
+            self.j1_idx = _resize(self.j1_idx, length)
+            self.j2_idx = _resize(self.j2_idx, length)
+            self.crossover = _resize(self.crossover, length)
+            self.vec = _resize(self.vec, length)
+            self.norm = _resize(self.norm, length)
+            self.unit = _resize(self.unit, length)
+            self.t_hookes = _resize(self.t_hookes, length)
+            self.t_growth = _resize(self.t_growth, length)
+            self.t_contracting = _resize(self.t_contracting, length)
+
     def addJunction(self, x, y, **kargs):
         """ Creates a junction """
 
-        junction = Junction(x, y)
+        self._grow_arrays()
+        i = self.n_junctions
+        self.n_junctions += 1
 
-        junction.anchor = kargs.get('anchor', False)
-        junction.growing = kargs.get('growing', False)
-        junction.flowing = kargs.get('flowing', self.flowing)
-        junction.flowrate = kargs.get('flowrate', self.flowrate)
-        junction.dragrate = kargs.get('dragrate', self.dragrate)
-        junction.width = kargs.get('width', self.width)
-        junction.cross = kargs.get('cross', 0)
+        self.alive_j[i] = True
+        self.pos[i] = (x, y)
+        self.vel[i] = (0.0, 0.0)
+        self.anchor[i] = kargs.get('anchor', False)
+        self.growing[i] = kargs.get('growing', False)
+        self.cross[i] = kargs.get('cross', 0)
+        self.j_flowing[i] = kargs.get('flowing', self.flowing)
+        self.j_flowrate[i] = kargs.get('flowrate', self.flowrate)
+        self.j_dragrate[i] = kargs.get('dragrate', self.dragrate)
 
+        self._incidence_stale = True
+        self.static_mask = None
+
+        junction = Junction(self, i)
         self.junctions.append(junction)
         return(junction)
 
     def addTubule(self, j1, j2, **kargs):
         """ Creates a tubule between two junctions """
 
-        tubule = Tubule(j1, j2)
+        self._grow_arrays()
+        i = self.n_tubules
+        self.n_tubules += 1
+
+        self.alive_t[i] = True
+        self.j1_idx[i] = j1.index
+        self.j2_idx[i] = j2.index
+        self.crossover[i] = kargs.get('crossover', 0)
+        self.t_hookes[i] = kargs.get('hookes', self.hookes)
+        self.t_growth[i] = kargs.get('growth', self.growth)
+        self.t_contracting[i] = kargs.get('contracting', self.contracting)
 
-        tubule.hookes = kargs.get('hookes', self.hookes)
-        tubule.growth = kargs.get('growth', self.growth)
-        tubule.width = kargs.get('growth', self.width)
-        tubule.crossover = kargs.get('crossover', 0)
+        self._incidence_stale = True
+        self.static_mask = None
 
-        j1.adjacent.append(j2)
-        j2.adjacent.append(j1)
+        tubule = Tubule(self, i, j1, j2)
+        tubule.updateTubule()
+        self._sys_len += float(self.norm[i])
+        self._norm_cumsum = None
+
+        j1.adjacent.add(j2)
+        j2.adjacent.add(j1)
 
         self.tubules.append(tubule)
         return(tubule)
 
+    def removeJunction(self, j):
+        """ Flags a junction as dead - its row is dropped at the
+            next compaction """
+
+        # Handles dropped by compaction no longer own a row
+        if j.index is None:
+            return
+
+        self.alive_j[j.index] = False
+        self._incidence_stale = True
+
+    def removeTubule(self, t):
+        """ Flags a tubule as dead - its row is dropped at the
+            next compaction """
+
+        # Removing a tubule twice would take its length off the
+        # system length twice
+        if not t.alive:
+            return
+
+        self.alive_t[t.index] = False
+        self._incidence_stale = True
+        self.static_mask = None
+        self._sys_len -= float(self.norm[t.index])
+        self._norm_cumsum = None
+
+    def _compact(self):
+        """ Drops dead rows from the junction and tubule arrays and
+            renumbers the remaining rows """
+
+        keep = np.flatnonzero(self.alive_j[:self.n_junctions])
+        old_to_new = np.full(self.n_junctions, -1, dtype=np.intp)
+        old_to_new[keep] = np.arange(len(keep))
+        for array in (self.alive_j, self.pos, self.vel, self.anchor,
+                      self.growing, self.cross, self.j_flowing,
+                      self.j_flowrate, self.j_dragrate):
+            array[:len(keep)] = array[keep]
+        self.n_junctions = len(keep)
+
+        # Dropped handles are marked dead so they can't alias the
+        # live row that takes over their old index
+        for junction in self.junctions:
+            junction.index = None
+        self.junctions = [self.junctions[i] for i in keep]
+        for (i, junction) in enumerate(self.junctions):
+            junction.index = i
+
+        keep = np.flatnonzero(self.alive_t[:self.n_tubules])
+        for array in (self.alive_t, self.j1_idx, self.j2_idx,
+                      self.crossover, self.vec, self.norm, self.unit,
+                      self.t_hookes, self.t_growth, self.t_contracting):
+            array[:len(keep)] = array[keep]
+        self.n_tubules = len(keep)
+        self.j1_idx[:self.n_tubules] = old_to_new[self.j1_idx[:self.n_tubules]]
+        self.j2_idx[:self.n_tubules] = old_to_new[self.j2_idx[:self.n_tubules]]
+        for tubule in self.tubules:
+            tubule.index = None
+        self.tubules = [self.tubules[i] for i in keep]
+        for (i, tubule) in enumerate(self.tubules):
+            tubule.index = i
+
+        self._incidence_stale = True
+        self._norm_cumsum = None
+        self.static_mask = None
+
+        # Resums the system length so rounding error can't build up
+        self._sys_len = float(self.norm[:self.n_tubules].sum(
+            dtype=np.float64))
+
+    def _rebuild_incidence(self):
+        """ Lists the live tubules that end at each junction, sorted
+            by junction - the tubules ending at junction j are
+            inc_tubule[inc_start[j]:inc_start[j + 1]] """
+
+        if not self._incidence_stale:
+            return
+
+        live = np.flatnonzero(self.alive_t[:self.n_tubules])
+        ends = np.concatenate([self.j1_idx[live], self.j2_idx[live]])
+        order = np.argsort(ends, kind='stable')
+
+        self.inc_tubule = np.concatenate([live, live])[order]
+        self.inc_sign = np.repeat(FLOAT([1, -1]), len(live))[order]
+        self.inc_start = np.searchsorted(ends[order],
+                                         np.arange(self.n_junctions + 1))
+        self._incidence_stale = False
+
     def splitTubule(self):
         """ Picks a point along the system length to grow
             a new tubule from """
 
-        # Sum vector length and pick a random float less than that sum
-        sys_len = sum(t.norm for t in self.tubules)
-        split_len = random.uniform(0, sys_len)
-
-        for t in self.tubules:
-
-            # This method picks which tubule to split from by continually
-            # subtracting the norm of each vector from the system length
-            # until the remaining length is smaller than the norm of the
-            # current vector
-            if split_len > t.norm:
-                split_len -= t.norm
-
-            else:
-
-                s2_vec = np.array([-t.unit[1], t.unit[0]])
-                s2_vec *= random.choice([-1, 1])
-
-                s1_pos = t.j1.position + split_len * t.unit
-                s2_pos = s1_pos + 0.1 * s2_vec
-
-                s_j1_crossover = 0
-                s_j2_crossover = 0
-                sp_crossover = 0
-
-                # This stuff is kind of funky but prevents crossover
-                # errors
-                if t.crossover > 0:
-                    if s1_pos[0] < t.j2.position[0]:
-                        s_j1_crossover = -1
-                    elif s1_pos[0] > t.j1.position[0]:
-                        s_j2_crossover = 1
-                elif t.crossover < 0:
-                    if s1_pos[0] < t.j1.position[0]:
-                        s_j2_crossover = -1
-                    elif s1_pos[0] > t.j2.position[0]:
-                        s_j1_crossover = 1
-
-                if s2_pos[0] > self.width and s1_pos[0] < self.width:
-                    sp_crossover += 1
-                elif s2_pos[0] < 0 and s1_pos[0] > 0:
-                    sp_crossover -= 1
-
-                s1 = self.addJunction(s1_pos[0], s1_pos[1])
-                s2 = self.addJunction(s2_pos[0], s2_pos[1], growing=True)
-
-                # Not sure why but removing junctions from another
-                # junction's adjacency list sometimes raises exceptions
-                # in this method but not in mergeTubule
-                try:
-                    t.j1.adjacent.remove(t.j2)
-                except ValueError:
-                    pass
-                try:
-                    t.j2.adjacent.remove(t.j1)
-                except ValueError:
-                    pass
-
-                self.addTubule(s1, t.j1, crossover=s_j1_crossover)
-                self.addTubule(s1, t.j2, crossover=s_j2_crossover)
-                self.addTubule(s1, s2, crossover=sp_crossover)
-
-                t.to_remove = t
-
-                return
-
-    def mergeTubule(self, j):
+        # Pick a random float less than the system length, then find
+        # the tubule it falls in by binary search over the running
+        # sum of the tubule lengths
+        if self._norm_cumsum is None:
+            self._live_t = np.flatnonzero(self.alive_t[:self.n_tubules])
+            self._norm_cumsum = np.cumsum(self.norm[self._live_t],
+                                          dtype=np.float64)
+        if not len(self._live_t):
+            return
+        split_len = random.uniform(0, self._sys_len)
+
+        k = np.searchsorted(self._norm_cumsum, split_len)
+        k = min(k, len(self._live_t) - 1)
+        t = self.tubules[self._live_t[k]]
+        split_len -= self._norm_cumsum[k] - t.norm
+
+        (ux, uy) = t.unit.tolist()
+        side = random.choice([-1, 1])
+
+        # s1 sits on the tubule and s2 just off it to one side
+        (s1_x, s1_y) = t.j1.position.tolist()
+        s1_x += split_len * ux
+        s1_y += split_len * uy
+        s2_x = s1_x - 0.1 * side * uy
+        s2_y = s1_y + 0.1 * side * ux
+
+        s_j1_crossover = 0
+        s_j2_crossover = 0
+        sp_crossover = 0
+
+        # This stuff is kind of funky but prevents crossover
+        # errors
+        if t.crossover > 0:
+            if s1_x < t.j2.position[0]:
+                s_j1_crossover = -1
+            elif s1_x > t.j1.position[0]:
+                s_j2_crossover = 1
+        elif t.crossover < 0:
+            if s1_x < t.j1.position[0]:
+                s_j2_crossover = -1
+            elif s1_x > t.j2.position[0]:
+                s_j1_crossover = 1
+
+        if s2_x > self.width and s1_x < self.width:
+            sp_crossover += 1
+        elif s2_x < 0 and s1_x > 0:
+            sp_crossover -= 1
+
+        s1 = self.addJunction(s1_x, s1_y)
+        s2 = self.addJunction(s2_x, s2_y, growing=True)
+
+        # mergeTubule only drops the merged tubule's ends from
+        # the open junction's adjacency set, so either end here
+        # may already be missing
+        t.j1.adjacent.discard(t.j2)
+        t.j2.adjacent.discard(t.j1)
+
+        self.addTubule(s1, t.j1, crossover=s_j1_crossover)
+        self.addTubule(s1, t.j2, crossover=s_j2_crossover)
+        self.addTubule(s1, s2, crossover=sp_crossover)
+
+        self.removeTubule(t)
+
+    def _rebuild_hash(self):
+        """ Bins the tubules into grid cells about half the length
+            of the longest tubule """
+
+        n = self.n_tubules
+        cell_size = max(1.0, np.nanmax(self.norm[:n], initial=0) / 2)
+
+        # Cell width divides the substrate width so cells line up
+        # across the periodic x bound
+        self.n_cx = max(1, int(self.width // cell_size))
+        self.cell_w = self.width / self.n_cx
+        self.cell_h = cell_size
+        self.n_hash = 2 * n + 1
+
+        self.cell_start, self.cell_tubules, self.t_aabb = _build_hash(
+            self.pos, self.j1_idx[:n], self.j2_idx[:n], self.alive_t[:n],
+            self.crossover[:n], self.norm[:n], self.width, self.cell_w,
+            self.cell_h, self.n_cx, self.n_hash)
+
+    def mergeTubules(self):
         """ Connects tubules when the open end of one tubule
             intersects a different tubule it isn't already
             attached to """
 
-        if j.growing:
+        junctions = []
+        for i in np.flatnonzero(self.growing[:self.n_junctions]):
+            j = self.junctions[i]
 
             # Prevents self attachment
             if j.just_split:
                 j.just_split = False
-                return
-
-            # This is a nested loop that runs pretty inefficiently -
-            # this method is where you should look if you want to
-            # optimize this sim
-            for t in self.tubules:
-
-                if j in t.j1.adjacent:
-                    pass
-                elif j in t.j2.adjacent:
-                    pass
-
-                else:
-
-                    # I'd prefer not to assign all these variables
-                    # each time this function loops around but
-                    # I'd need to figure out a better way to check
-                    # all the vector values quickly
-                    j.vector = j.position - t.j1.position
-                    if t.crossover > 0:
-                        if j.position[0] < t.j2.position[0]:
-                            j.vector[0] += self.width
-                    elif t.crossover < 0:
-                        if j.position[0] > t.j2.position[0]:
-                            j.vector[0] -= self.width
-                    j_norm = np.linalg.norm(j.vector)
-                    j_unit = j.vector / j_norm
-
-                    # Sets conditions for merging - more
-                    # forgiving when j_norm is small to prevent
-                    # crossovers
-                    if j_norm < 0.1:
-                        col_check = 0
-                    elif j_norm < 1:
-                        col_check = 0.9
-                    else:
-                        col_check = 0.999
-
-                    # Prevents attachment from outside the tubule's
-                    # max length
-                    if j_norm > t.norm:
-                        pass
-
-                    # This is the most accurate algorithm I've been
-                    # able to come up with - it dots the vector from
-                    # tubule end 1 to tubule end 2 with the vector
-                    # from tubule end 1 to the open junction, and if
-                    # they're close enough to collinear then it attaches
-                    elif np.dot(j_unit, t.unit) > col_check:
-
-                        j1_crossover = 0
-                        j2_crossover = 0
-
-                        # Prevents crossover errors
-                        if t.crossover > 0:
-                            if j.position[0] < t.j2.position[0]:
-                                j1_crossover = -1
-                            elif j.position[0] > t.j1.position[0]:
-                                j2_crossover = 1
-                        elif t.crossover < 0:
-                            if j.position[0] < t.j1.position[0]:
-                                j2_crossover = -1
-                            elif j.position[0] > t.j2.position[0]:
-                                j1_crossover = 1
-
-                        self.addTubule(j, t.j1, crossover=j1_crossover)
-                        self.addTubule(j, t.j2, crossover=j2_crossover)
-
-                        j.adjacent.remove(t.j1)
-                        j.adjacent.remove(t.j2)
-
-                        j.growing = False
-                        t.to_remove = t
-                        break
-
-    def pruneTubule(self, t):
+            else:
+                junctions.append(j)
+
+        if not junctions:
+            return
+
+        # Pairs every open junction with each tubule in its cell of
+        # the spatial hash - pairs stay ordered by junction and then
+        # by tubule
+        self._rebuild_hash()
+        g = np.array([j.index for j in junctions])
+        buckets = _find_buckets(self.pos[g], self.cell_w, self.cell_h,
+                                self.n_cx, self.n_hash)
+        starts = self.cell_start[buckets]
+        counts = self.cell_start[buckets + 1] - starts
+        pair_j = np.repeat(np.arange(len(g)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(counts.cumsum() - counts,
+                                                      counts)
+        pair_t = self.cell_tubules[np.repeat(starts, counts) + offsets]
+
+        compiled = (TubuleMergePBC is not None
+                    and self.norm.dtype == np.float32
+                    and self.pos.dtype == np.float64)
+        if compiled:
+            hits = TubuleMergePBC.mergeHits(
+                self.pos, g[pair_j], pair_t, self.j1_idx, self.j2_idx,
+                self.crossover, self.norm, self.unit, self.t_aabb,
+                self.width)
+        else:
+            hits = self._merge_hits(g[pair_j], pair_t)
+
+        # Each junction attaches to the first tubule it hits that it
+        # isn't already connected to
+        for k in np.flatnonzero(hits):
+            j = junctions[pair_j[k]]
+            t = self.tubules[pair_t[k]]
+            if not (j.growing and t.alive):
+                continue
+            if j in t.j1.adjacent or j in t.j2.adjacent:
+                continue
+            self.mergeTubule(j, t)
+
+    def _merge_hits(self, j_idx, t_idx):
+        """ Returns whether each open junction j_idx[k] is close
+            enough to collinear with tubule t_idx[k] to merge into it,
+            testing every pair at once """
+
+        # Open junction position, corrected for tubules that cross
+        # the x bound
+        t2 = self.j2_idx[t_idx]
+        (jx, jy) = self.pos[j_idx].T
+        crossover = self.crossover[t_idx]
+        jx = jx + self.width * ((crossover > 0) & (jx < self.pos[t2, 0]))
+        jx -= self.width * ((crossover < 0) & (jx > self.pos[t2, 0]))
+
+        # Only pairs inside the tubule's padded bounding box from
+        # _rebuild_hash can merge, so the rest skip the vector math
+        box = self.t_aabb[t_idx]
+        near = np.flatnonzero((box[:, 0] <= jx) & (jx <= box[:, 1])
+                              & (box[:, 2] <= jy) & (jy <= box[:, 3]))
+        hits = np.zeros(len(t_idx), dtype=bool)
+        t_idx = t_idx[near]
+
+        # Vector from tubule end 1 to the open junction
+        t1 = self.j1_idx[t_idx]
+        j_vector = np.stack((jx[near] - self.pos[t1, 0],
+                             jy[near] - self.pos[t1, 1]), 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            j_norm = np.sqrt((j_vector * j_vector).sum(1))
+            j_unit = j_vector / j_norm[:, None]
+            dots = (j_unit * self.unit[t_idx]).sum(1)
+
+        # Sets conditions for merging - more forgiving when j_norm
+        # is small to prevent crossovers
+        col_check = np.where(j_norm < 0.1, 0,
+                             np.where(j_norm < 1, 0.9, 0.999))
+
+        # This is the most accurate algorithm I've been able to come
+        # up with - it dots the vector from tubule end 1 to tubule
+        # end 2 with the vector from tubule end 1 to the open junction,
+        # and if they're close enough to collinear then it attaches.
+        # Attachment from outside the tubule's max length is ignored
+        hits[near] = (j_norm <= self.norm[t_idx]) & (dots > col_check)
+        return(hits)
+
+    def mergeTubule(self, j, t):
+        """ Attaches open junction j to the middle of tubule t,
+            splitting t in two """
+
+        j1_crossover = 0
+        j2_crossover = 0
+
+        # Prevents crossover errors
+        if t.crossover > 0:
+            if j.position[0] < t.j2.position[0]:
+                j1_crossover = -1
+            elif j.position[0] > t.j1.position[0]:
+                j2_crossover = 1
+        elif t.crossover < 0:
+            if j.position[0] < t.j1.position[0]:
+                j2_crossover = -1
+            elif j.position[0] > t.j2.position[0]:
+                j1_crossover = 1
+
+        self.addTubule(j, t.j1, crossover=j1_crossover)
+        self.addTubule(j, t.j2, crossover=j2_crossover)
+
+        j.adjacent.remove(t.j1)
+        j.adjacent.remove(t.j2)
+
+        j.growing = False
+        self.removeTubule(t)
+
+    def pruneTubules(self):
         """ Removes tubules given certain conditions - unimplemented"""
 
-    def pruneJunction(self, j):
+    def pruneJunctions(self):
         """ Removes junctions given certain conditions - unimplemented """
 
-    def boundSubstrate(self, j):
+    def moveJunctions(self):
+        """ Updates positions with given velocity, acceleration,
+            and drag """
+
+        n = self.n_junctions
+        _step_move(self.pos[:n], self.vel[:n], self.anchor[:n],
+                   self.j_flowrate[:n], self.j_dragrate[:n],
+                   self.j_flowing[:n], self.cross[:n], self.width)
+
+    def boundSubstrate(self):
         """ Anchors junctions when they hit a boundary - y bounds
             are enabled by default and x bounds can be enabled for
             debugging """
 
-        if self.bound_x:
-            if j.position[0] > self.width:
-                j.position[0] = self.width
-                j.anchor = True
-                j.growing = False
-            elif j.position[0] < 0:
-                j.position[0] = 0
-                j.anchor = True
-                j.growing = False
-
-        if j.position[1] > self.height:
-            j.position[1] = self.height
-            j.anchor = True
-            j.growing = False
-        elif j.position[1] < 0:
-            j.position[1] = 0
-            j.anchor = True
-            j.growing = False
-
-    def wrapSubstrate(self, t):
+        n = self.n_junctions
+        if _step_bound(self.pos[:n], self.anchor[:n], self.growing[:n],
+                       self.width, self.height, self.bound_x):
+            self.static_mask = None
+
+    def _active_tubules(self):
+        """ Returns the tubules the update kernel has to visit """
+
+        if self.static_mask is not None:
+            return(self._active_t)
+
+        n = self.n_tubules
+        still = self.anchor & ~self.growing & ~self.j_flowing
+        alive = self.alive_t[:n]
+        self.static_mask = (alive & still[self.j1_idx[:n]]
+                            & still[self.j2_idx[:n]])
+        self._active_t = np.flatnonzero(alive & ~self.static_mask)
+
+        # An end may have moved since the last update before it
+        # stopped, so every tubule is updated once more here
+        return(np.flatnonzero(alive))
+
+    def updateTubules(self):
+        """ Updates every tubule vector once per unit time """
+
+        n = self.n_tubules
+        self._sys_len += _step_update_tubule(
+            self.pos, self.j1_idx[:n], self.j2_idx[:n],
+            self._active_tubules(), self.crossover[:n], self.width,
+            self.vec[:n], self.norm[:n], self.unit[:n])
+        self._norm_cumsum = None
+
+    def contractTubules(self):
+        """ Pulls tubule ends together (Hooke's Law) """
+
+        self._gather(contract=True, grow=False)
+
+    def growTubules(self):
+        """ Grows open tubules """
+
+        self._gather(contract=False, grow=True)
+
+    def _gather(self, contract, grow):
+        """ Applies contraction and/or growth from the current
+            tubule vectors """
+
+        self._rebuild_incidence()
+        n = self.n_junctions
+        _step_gather(self.pos[:n], self.vel[:n], self.inc_start,
+                     self.inc_tubule, self.inc_sign, self.vec, self.unit,
+                     self.t_hookes, self.t_growth, self.t_contracting,
+                     self.anchor[:n], self.growing[:n], contract, grow)
+
+    def wrapSubstrate(self):
         """ Keeps track of tubules that cross the x bound and which
             junction crossed - works without need for a new anchor
             point attached to the side walls """
 
         if self.wrap_x:
+            n = self.n_tubules
 
-            if t.j1.position[0] > self.width:
-                t.crossover -= 1
-                if t.crossover < -1:
-                    t.crossover = -1
-                t.j1.cross += 1
-                if t.j1.cross > 1:
-                    t.j1.cross = 1
-            elif t.j1.position[0] < 0:
-                t.crossover += 1
-                if t.crossover > 1:
-                    t.crossover = 1
-                t.j1.cross -= 1
-                if t.j1.cross < -1:
-                    t.j1.cross = -1
-
-            if t.j2.position[0] > self.width:
-                t.crossover += 1
-                if t.crossover > 1:
-                    t.crossover = 1
-                t.j2.cross += 1
-                if t.j2.cross > 1:
-                    t.j2.cross = 1
-            elif t.j2.position[0] < 0:
-                t.crossover -= 1
-                if t.crossover < -1:
-                    t.crossover = -1
-                t.j2.cross -= 1
-                if t.j2.cross < -1:
-                    t.j2.cross = -1
+            # A changed crossover changes the tubule vector, so static
+            # tubules have to be updated again
+            if _step_wrap(self.pos, self.j1_idx[:n], self.j2_idx[:n],
+                          self.alive_t[:n], self.crossover[:n], self.cross,
+                          self.width):
+                self.static_mask = None
 
     def initSubstrate(self):
         """ Creates two initial vertical tubules """
@@ -417,10 +998,9 @@ class Substrate:
     def updateSubstrate(self):
         """ Runs all functions that need to run each timestep """
 
-        for f in self.j_functions:
-            for junction in self.junctions:
-                f(junction)
+        for step in self._tick_plan:
+            step()
 
-        for f in self.t_functions:
-            for tubule in self.tubules:
-                f(tubule)
+        self.ticks += 1
+        if self.ticks % self.compact_every == 0:
+            self._compact()